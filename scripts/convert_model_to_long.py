@@ -21,7 +21,8 @@
 # In[ ]:
 
 
-#get_ipython().system('pip install transformers==3.0.2')
+# `RobertaLong` uses the `longformer` package, which installs the `transformers` fork pinned in its `requirements.txt`
+#get_ipython().system('pip install git+https://github.com/allenai/longformer.git')
 
 
 # In[2]:
@@ -30,20 +31,37 @@
 import logging
 import os
 import math
-import copy
+import hashlib
+import importlib.util
+import contextlib
+import inspect
+import itertools
+import numpy as np
 import torch
+import transformers
+from torch import nn
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 from dataclasses import dataclass, field
-from transformers import RobertaForMaskedLM, RobertaTokenizerFast, TextDataset, DataCollatorForLanguageModeling, Trainer
-from transformers import TrainingArguments, HfArgumentParser
-from transformers.modeling_longformer import LongformerSelfAttention
+from transformers import RobertaConfig, RobertaForMaskedLM, RobertaTokenizerFast, DataCollatorForLanguageModeling, Trainer
+from transformers import TrainingArguments, HfArgumentParser, modeling_bert
+from longformer.longformer import LongformerSelfAttention
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+try:
+    from numba import njit
+except ImportError:
+    NUMBA_AVAILABLE = False
+else:
+    NUMBA_AVAILABLE = True
+
 
 # ### RobertaLong
 # 
-# `RobertaLongForMaskedLM` represents the "long" version of the `RoBERTa` model. It replaces `BertSelfAttention` with `RobertaLongSelfAttention`, which is a thin wrapper around `LongformerSelfAttention`.
+# `RobertaLongForMaskedLM` represents the "long" version of the `RoBERTa` model. It replaces `BertSelfAttention` with `RobertaLongSelfAttention`, which is a thin wrapper around `longformer.LongformerSelfAttention`. `config.attention_mode` selects its implementation (`--attention_mode`); we use `sliding_chunks`, the fastest one. `sliding_chunks_no_overlap` uses less memory and `tvm` (custom CUDA kernel) the least, but both are slower. The number of tokens with global attention should not exceed the attention window (`2 * config.attention_window`, which is stored per side).
+# 
+# Configs saved by older versions of this notebook (based on `transformers.modeling_longformer`) store the full window and have no `attention_dilation`; `RobertaLongForMaskedLM` converts them when loading.
 # 
 
 # In[3]:
@@ -59,15 +77,65 @@ class RobertaLongSelfAttention(LongformerSelfAttention):
         encoder_attention_mask=None,
         output_attentions=False,
     ):
-        return super().forward(hidden_states, attention_mask=attention_mask, output_attentions=output_attentions)
+        if attention_mask is not None and self.layer_id == 0:
+            # `attention_mask` > 0 marks tokens with global attention. The mask is the same in all layers, so
+            # only check it once per forward pass (`.max()` syncs with the gpu)
+            max_num_global_tokens = (attention_mask > 0).sum(dim=-1).max()
+            # `self.attention_window` is per side; the cap is the full window
+            assert max_num_global_tokens <= 2 * self.attention_window, \
+                f'{max_num_global_tokens} global attention tokens exceed attention window {2 * self.attention_window}'
+        return super().forward(hidden_states, attention_mask=attention_mask, head_mask=head_mask,
+                               output_attentions=output_attentions)
+
+
+class _ModulePlaceholder(nn.Module):
+    # stands in for modules that would be replaced right after they are built
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+
+@contextlib.contextmanager
+def _replaced_attr(obj, name, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
 
 
 class RobertaLongForMaskedLM(RobertaForMaskedLM):
     def __init__(self, config):
-        super().__init__(config)
+        if not hasattr(config, 'attention_dilation'):
+            # config of a model converted with `transformers.modeling_longformer.LongformerSelfAttention`,
+            # which stores the full window size instead of the window size on each side
+            logger.info('Converting the attention window of an old RobertaLong config to the window on each side')
+            config.attention_window = tuple(window // 2 for window in config.attention_window)
+            config.attention_dilation = (1,) * config.num_hidden_layers
+            config.autoregressive = False
+            if not hasattr(config, 'attention_mode'):
+                config.attention_mode = 'sliding_chunks'
+        # don't allocate and initialize `modeling_bert.BertSelfAttention` objects that are replaced right away
+        with _replaced_attr(modeling_bert, 'BertSelfAttention', _ModulePlaceholder):
+            super().__init__(config)
         for i, layer in enumerate(self.roberta.encoder.layer):
             # replace the `modeling_bert.BertSelfAttention` object with `LongformerSelfAttention`
             layer.attention.self = RobertaLongSelfAttention(config, layer_id=i)
+            layer.attention.self.apply(self._init_weights)
+
+
+# `_clone_linear` makes an independent copy of a projection layer. It is used instead of `copy.deepcopy` which walks the full module object graph.
+
+# In[ ]:
+
+
+def _clone_linear(linear):
+    out = nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+    out = out.to(device=linear.weight.device, dtype=linear.weight.dtype)
+    out.weight.data.copy_(linear.weight.data)
+    if linear.bias is not None:
+        out.bias.data.copy_(linear.bias.data)
+    return out
 
 
 # Starting from the `roberta-base` checkpoint, the following function converts it into an instance of `RobertaLong`. It makes the following changes:
@@ -76,14 +144,16 @@ class RobertaLongForMaskedLM(RobertaForMaskedLM):
 # 
 # - initialize the additional position embeddings by copying the embeddings of the first `512` positions. This initialization is crucial for the model performance (check table 6 in [the paper](https://arxiv.org/pdf/2004.05150.pdf) for performance without this initialization)
 # 
-# - replaces `modeling_bert.BertSelfAttention` objects with `modeling_longformer.LongformerSelfAttention` with a attention window size `attention_window`
+# - replaces `modeling_bert.BertSelfAttention` objects with `RobertaLongSelfAttention` with a attention window size `attention_window`, so the returned model can be used right away without reloading it from the disk
+# 
+# - shares the global projections `query_global`, `key_global`, `value_global` with the local `query`, `key`, `value` (same modules, not copies)
 # 
 # The output of this function works for long documents even without pretraining. Check tables 6 and 11 in [the paper](https://arxiv.org/pdf/2004.05150.pdf) to get a sense of the expected performance of this model before pretraining.
 
 # In[ ]:
 
 
-def create_long_model(save_model_to, attention_window, max_pos):
+def create_long_model(save_model_to, attention_window, max_pos, attention_mode='sliding_chunks'):
     model = RobertaForMaskedLM.from_pretrained('roberta-base')
     tokenizer = RobertaTokenizerFast.from_pretrained('roberta-base', model_max_length=max_pos)
     config = model.config
@@ -95,31 +165,47 @@ def create_long_model(save_model_to, attention_window, max_pos):
     max_pos += 2  # NOTE: RoBERTa has positions 0,1 reserved, so embedding size is max position + 2
     config.max_position_embeddings = max_pos
     assert max_pos > current_max_pos
-    # allocate a larger position embedding matrix
-    new_pos_embed = model.roberta.embeddings.position_embeddings.weight.new_empty(max_pos, embed_size)
+    # allocate a larger position embedding matrix. Build an `nn.Embedding` of the new size instead of
+    # swapping `weight.data`, to keep its metadata consistent, and fill its weight in place
+    old_pos_embed = model.roberta.embeddings.position_embeddings.weight
+    new_position_embeddings = nn.Embedding(
+        max_pos, embed_size, padding_idx=model.roberta.embeddings.position_embeddings.padding_idx)
+    new_pos_embed = new_position_embeddings.weight.data
+    new_pos_embed[:2] = old_pos_embed.data[:2]
     # copy position embeddings over and over to initialize the new position embeddings
-    k = 2
+    # (a single `repeat` instead of one slice-copy per `step` rows)
     step = current_max_pos - 2
-    while k < max_pos - 1:
-        new_pos_embed[k:(k + step)] = model.roberta.embeddings.position_embeddings.weight[2:]
-        k += step
-    model.roberta.embeddings.position_embeddings.weight.data = new_pos_embed
-    #model.roberta.embeddings.position_ids.data = torch.tensor([i for i in range(max_pos)]).reshape(1, max_pos)
-
-    # replace the `modeling_bert.BertSelfAttention` object with `LongformerSelfAttention`
-    config.attention_window = [attention_window] * config.num_hidden_layers
-    for i, layer in enumerate(model.roberta.encoder.layer):
-        longformer_self_attn = LongformerSelfAttention(config, layer_id=i)
+    reps = math.ceil((max_pos - 2) / step)
+    new_pos_embed[2:] = old_pos_embed.data[2:].repeat(reps, 1)[:max_pos - 2]
+    model.roberta.embeddings.position_embeddings = new_position_embeddings
+    # keep `position_ids` in sync with the new size; register it as a buffer so `.to(device)` moves it
+    position_ids = torch.arange(max_pos, dtype=torch.long).unsqueeze(0)
+    if 'position_ids' in model.roberta.embeddings._buffers:
+        model.roberta.embeddings.position_ids = position_ids
+    else:
+        model.roberta.embeddings.register_buffer('position_ids', position_ids)
+
+    # `longformer.LongformerSelfAttention` expects the window size on each side of the token
+    # per-layer settings are stored as tuples (they are saved as lists in `config.json`)
+    config.attention_window = (attention_window // 2,) * config.num_hidden_layers
+    config.attention_dilation = (1,) * config.num_hidden_layers
+    config.autoregressive = False
+    config.attention_mode = attention_mode
+
+    # replace the `modeling_bert.BertSelfAttention` object with `LongformerSelfAttention`, reusing the
+    # pretrained `query`, `key`, `value` modules as they are (no copies)
+    layers = model.roberta.encoder.layer
+    longformer_self_attns = [RobertaLongSelfAttention(config, layer_id=i) for i in range(len(layers))]
+    for layer, longformer_self_attn in zip(layers, longformer_self_attns):
         longformer_self_attn.query = layer.attention.self.query
         longformer_self_attn.key = layer.attention.self.key
         longformer_self_attn.value = layer.attention.self.value
-
-        longformer_self_attn.query_global = copy.deepcopy(layer.attention.self.query)
-        longformer_self_attn.key_global = copy.deepcopy(layer.attention.self.key)
-        longformer_self_attn.value_global = copy.deepcopy(layer.attention.self.value)
-
         layer.attention.self = longformer_self_attn
 
+    # MLM pretraining doesn't update the global projections, so share them with the local ones
+    # until `copy_proj_layers` gives them their own parameters
+    share_proj_layers(model)
+
     logger.info(f'saving model to {save_model_to}')
     model.save_pretrained(save_model_to)
     tokenizer.save_pretrained(save_model_to)
@@ -127,41 +213,230 @@ def create_long_model(save_model_to, attention_window, max_pos):
 
 
 # Pretraining on Masked Language Modeling (MLM) doesn't update the global projection layers. After pretraining, the following function copies `query`, `key`, `value` to their global counterpart projection matrices.
+# `create_long_model` shares the global projections with the local ones, so `copy_proj_layers` must be called before finetuning on tasks that use global attention; it breaks the sharing by giving each global projection its own parameters. Global projections that are not shared are left untouched unless `force=True`. Saving and loading a model also breaks the sharing; `share_proj_layers` restores it.
 # For more explanation on "local" vs. "global" attention, please refer to the documentation [here](https://huggingface.co/transformers/model_doc/longformer.html#longformer-self-attention).
 
 # In[ ]:
 
 
-def copy_proj_layers(model):
+def share_proj_layers(model):
     for i, layer in enumerate(model.roberta.encoder.layer):
-        layer.attention.self.query_global = copy.deepcopy(layer.attention.self.query)
-        layer.attention.self.key_global = copy.deepcopy(layer.attention.self.key)
-        layer.attention.self.value_global = copy.deepcopy(layer.attention.self.value)
+        layer.attention.self.query_global = layer.attention.self.query
+        layer.attention.self.key_global = layer.attention.self.key
+        layer.attention.self.value_global = layer.attention.self.value
     return model
 
 
+def copy_proj_layers(model, force=False):
+    for i, layer in enumerate(model.roberta.encoder.layer):
+        self_attn = layer.attention.self
+        # global projections that are not shared have their own (maybe finetuned) weights; keep them unless `force`
+        if self_attn.query_global is self_attn.query or force:
+            self_attn.query_global = _clone_linear(self_attn.query)
+        if self_attn.key_global is self_attn.key or force:
+            self_attn.key_global = _clone_linear(self_attn.key)
+        if self_attn.value_global is self_attn.value or force:
+            self_attn.value_global = _clone_linear(self_attn.value)
+    return model
+
+
+# ### Pretokenized MLM data
+# 
+# Tokenizing the text files is slow, so it is done only once. `pretokenize` streams a text file through the tokenizer and writes the token ids into a `np.memmap` file. `PackedDataset` slices `block_size`-long instances out of this file and adds `<s>` and `</s>` to each of them.
+# 
+# For corpora that are too large to pretokenize, `StreamingPackedDataset` tokenizes the text file on the fly, one chunk of lines at a time, and packs the tokens into `block_size`-long instances without ever holding the whole corpus in memory. Chunks are split between the dataloader workers so tokenization runs in parallel, and between the processes of distributed training so each one trains on different instances. It streams the file in order (no shuffling), repeating it as needed to produce `num_instances` instances.
+
+# In[ ]:
+
+
+def _tokenize_lines(tokenizer, lines):
+    input_ids = tokenizer(lines, add_special_tokens=False)['input_ids']
+    return np.fromiter(itertools.chain.from_iterable(input_ids), dtype=np.uint16)
+
+
+def pretokenize(path, tokenizer, out_path, chunk_bytes=1 << 22):
+    assert len(tokenizer) < 65535  # will use uint16 to store token ids
+    logger.info(f'Tokenizing {path} into {out_path}')
+    with open(path, 'r', encoding='utf-8') as fin, open(f'{out_path}.tmp', 'wb') as fout:
+        while True:
+            lines = fin.readlines(chunk_bytes)
+            if not lines:
+                break
+            _tokenize_lines(tokenizer, lines).tofile(fout)
+    os.rename(f'{out_path}.tmp', out_path)  # only a complete file gets used as a cache
+
+
+class PackedDataset(Dataset):
+    def __init__(self, mmap_filename, block_size, bos_token_id, eos_token_id):
+        # `block_size - 2` to reserve space for <s> and </s>
+        self.num_instances = np.memmap(mmap_filename, mode='r', dtype=np.uint16).shape[0] // (block_size - 2)
+        # defer loading the token_ids memmap until the first __getitem__ call to avoid pickling it
+        self.token_ids = None
+        self._mmap_filename = mmap_filename
+        self._block_size = block_size
+        self._bos_token_id = bos_token_id
+        self._eos_token_id = eos_token_id
+
+    def __len__(self):
+        return self.num_instances
+
+    def __getitem__(self, i):
+        if self.token_ids is None:
+            self.token_ids = np.memmap(self._mmap_filename, mode='r', dtype=np.uint16)
+        from_index = i * (self._block_size - 2)
+        to_index = (i + 1) * (self._block_size - 2)
+        data = np.concatenate(([self._bos_token_id], self.token_ids[from_index:to_index], [self._eos_token_id]))
+        return torch.from_numpy(data.astype(np.int64))
+
+
+class StreamingPackedDataset(IterableDataset):
+    def __init__(self, file_path, tokenizer, block_size, num_instances, chunk_bytes=1 << 22):
+        assert len(tokenizer) < 65535  # will use uint16 to store token ids
+        self.num_instances = num_instances
+        self._file_path = file_path
+        self._tokenizer = tokenizer
+        self._block_size = block_size
+        self._chunk_bytes = chunk_bytes
+
+    def __len__(self):
+        return self.num_instances
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        num_instances = self.num_instances // num_workers + (worker_id < self.num_instances % num_workers)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        else:
+            rank, world_size = 0, 1
+        # each (rank, worker) tokenizes a different subset of the chunks
+        shard_id, num_shards = rank * num_workers + worker_id, world_size * num_workers
+        # `block_size - 2` to reserve space for <s> and </s>
+        instance_size = self._block_size - 2
+        token_ids = np.empty(0, dtype=np.uint16)
+        chunk_index = -1
+        while num_instances > 0:
+            with open(self._file_path, 'r', encoding='utf-8') as fin:
+                lines = fin.readlines(self._chunk_bytes)
+                if not lines:
+                    raise ValueError(f'{self._file_path} is empty')
+                while lines and num_instances > 0:
+                    chunk_index += 1
+                    if chunk_index % num_shards == shard_id:
+                        token_ids = np.concatenate((token_ids, _tokenize_lines(self._tokenizer, lines)))
+                        while len(token_ids) >= instance_size and num_instances > 0:
+                            data = np.concatenate(([self._tokenizer.bos_token_id], token_ids[:instance_size],
+                                                   [self._tokenizer.eos_token_id]))
+                            yield torch.from_numpy(data.astype(np.int64))
+                            token_ids = token_ids[instance_size:]
+                            num_instances -= 1
+                    lines = fin.readlines(self._chunk_bytes)
+
+
+def load_packed_dataset(tokenizer, file_path, block_size):
+    directory, filename = os.path.split(file_path)
+    # key the cache on the vocabulary, so that a different vocabulary doesn't reuse stale token ids
+    vocab_key = hashlib.md5(str(sorted(tokenizer.get_vocab().items())).encode()).hexdigest()[:12]
+    cache = os.path.join(directory, f'cached_ids_{tokenizer.__class__.__name__}_{vocab_key}_{filename}.bin')
+    if not os.path.exists(cache):
+        pretokenize(file_path, tokenizer, cache)
+    return PackedDataset(cache, block_size, tokenizer.bos_token_id, tokenizer.eos_token_id)
+
+
+# `NumbaDataCollatorForLanguageModeling` does the same MLM masking as `DataCollatorForLanguageModeling` (80% `<mask>`, 10% random token, 10% unchanged) but in a single compiled pass over the batch. Batches are built in parallel by the dataloader workers, so the kernel itself is single-threaded. It falls back to the `transformers` implementation if `numba` is not installed.
+
+# In[ ]:
+
+
+if NUMBA_AVAILABLE:
+    # not `parallel=True`: batches are already built in parallel by the dataloader worker processes, and numba's
+    # OpenMP threading layer kills forked workers that start a parallel region
+    @njit
+    def _mask_tokens(input_ids, labels, special_token_ids, mask_token_id, vocab_size, seeds, mlm_probability):
+        for i in range(input_ids.shape[0]):
+            np.random.seed(seeds[i])  # one seed per row, drawn from the torch RNG
+            for j in range(input_ids.shape[1]):
+                labels[i, j] = -100  # only compute loss on masked tokens
+                token_id = input_ids[i, j]
+                is_special = False
+                for special_token_id in special_token_ids:
+                    if token_id == special_token_id:
+                        is_special = True
+                if is_special or np.random.random() >= mlm_probability:
+                    continue
+                labels[i, j] = token_id
+                r = np.random.random()
+                if r < 0.8:
+                    input_ids[i, j] = mask_token_id
+                elif r < 0.9:
+                    input_ids[i, j] = np.random.randint(0, vocab_size)
+
+
+class NumbaDataCollatorForLanguageModeling(DataCollatorForLanguageModeling):
+    def mask_tokens(self, inputs):
+        if not NUMBA_AVAILABLE or not self.mlm:
+            return super().mask_tokens(inputs)
+        input_ids = inputs.numpy().copy()
+        labels = np.empty_like(input_ids)
+        special_token_ids = np.array([self.tokenizer.cls_token_id, self.tokenizer.sep_token_id,
+                                      self.tokenizer.pad_token_id], dtype=np.int64)
+        seeds = torch.randint(0, 2 ** 31 - 1, (input_ids.shape[0],)).numpy()  # follows the torch seed
+        _mask_tokens(input_ids, labels, special_token_ids, self.tokenizer.mask_token_id, len(self.tokenizer),
+                     seeds, self.mlm_probability)
+        return torch.from_numpy(input_ids), torch.from_numpy(labels)
+
+
 # ### Pretrain and Evaluate on masked language modeling (MLM)
 # 
-# The following function pretrains and evaluates a model on MLM.
+# `PretrainTrainer` builds the training batches (including the MLM masking) in `args.dataloader_num_workers` background worker processes that persist across epochs (torch >= 1.7), so that they overlap with the forward/backward pass. The following function pretrains and evaluates a model on MLM.
 
 # In[26]:
 
 
+class PretrainTrainer(Trainer):
+    def _dataloader_workers_kwargs(self):
+        num_workers = getattr(self.args, 'dataloader_num_workers', 0)
+        kwargs = {'num_workers': num_workers, 'pin_memory': getattr(self.args, 'dataloader_pin_memory', False)}
+        if 'persistent_workers' in inspect.signature(DataLoader.__init__).parameters:  # torch >= 1.7
+            kwargs['persistent_workers'] = num_workers > 0
+        return kwargs
+
+    def get_train_dataloader(self):
+        if isinstance(self.train_dataset, IterableDataset):
+            # `StreamingPackedDataset` splits the data between workers and distributed processes itself
+            # (instead of a `DistributedSampler`); an `IterableDataset` can't take a sampler
+            return DataLoader(self.train_dataset,
+                              batch_size=self.args.train_batch_size,
+                              collate_fn=self.data_collator,
+                              **self._dataloader_workers_kwargs())
+        dataloader = super().get_train_dataloader()
+        return DataLoader(dataloader.dataset,
+                          batch_size=dataloader.batch_size,
+                          sampler=dataloader.sampler,
+                          collate_fn=dataloader.collate_fn,
+                          drop_last=dataloader.drop_last,
+                          **self._dataloader_workers_kwargs())
+
+
 def pretrain_and_evaluate(args, model, tokenizer, eval_only, model_path):
-    val_dataset = TextDataset(tokenizer=tokenizer,
-                              file_path=args.val_datapath,
-                              block_size=tokenizer.max_len)
+    val_dataset = load_packed_dataset(tokenizer, args.val_datapath, block_size=tokenizer.max_len)
     if eval_only:
         train_dataset = val_dataset
     else:
-        logger.info(f'Loading and tokenizing training data is usually slow: {args.train_datapath}')
-        train_dataset = TextDataset(tokenizer=tokenizer,
-                                    file_path=args.train_datapath,
-                                    block_size=tokenizer.max_len)
-
-    data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=True, mlm_probability=0.15)
-    trainer = Trainer(model=model, args=args, data_collator=data_collator,
-                      train_dataset=train_dataset, eval_dataset=val_dataset, prediction_loss_only=True,)
+        if getattr(args, 'stream_train_data', False):
+            # the stream has no natural length; each process produces exactly `max_steps` of data
+            assert args.max_steps > 0
+            num_instances = args.max_steps * args.train_batch_size * args.gradient_accumulation_steps
+            logger.info(f'Streaming {num_instances} training instances from {args.train_datapath}')
+            train_dataset = StreamingPackedDataset(args.train_datapath, tokenizer, block_size=tokenizer.max_len,
+                                                   num_instances=num_instances)
+        else:
+            logger.info(f'Loading training data (tokenizing it is slow the first time): {args.train_datapath}')
+            train_dataset = load_packed_dataset(tokenizer, args.train_datapath, block_size=tokenizer.max_len)
+
+    data_collator = NumbaDataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=True, mlm_probability=0.15)
+    trainer = PretrainTrainer(model=model, args=args, data_collator=data_collator,
+                             train_dataset=train_dataset, eval_dataset=val_dataset, prediction_loss_only=True,)
 
     eval_loss = trainer.evaluate()
     eval_loss = eval_loss['eval_loss']
@@ -186,7 +461,7 @@ def pretrain_and_evaluate(args, model, tokenizer, eval_only, model_path):
 # 
 # - **Important note**: The lr-scheduler in [the paper](https://arxiv.org/pdf/2004.05150.pdf) is polynomial_decay with power 3 over 65k steps. To train for 3k steps, use a constant lr-scheduler (after warmup). Both lr-scheduler are not supported in HF trainer, and at least **constant lr-scheduler** will need to be added. 
 # 
-# - Pretraining will take 2 days on 1 x 32GB GPU with fp32. Consider using fp16 and using more gpus to train faster (if you increase `#gpus`, reduce `gradient_accumulation` to maintain `#tokens/batch` as mentioned earlier).
+# - Pretraining will take 2 days on 1 x 32GB GPU with fp32. If [apex](https://github.com/NVIDIA/apex) is installed, we train with fp16, which halves the memory, otherwise with fp32. Together with gradient checkpointing, which trades recomputation in the backward pass for activation memory, this lets us use a 4x larger batch size and 4x smaller `gradient_accumulation` (2x without apex). Note that apex `O2` casts the model itself to fp16, so after training the in-memory `model` and the weights that `copy_proj_layers` and `save_pretrained` write are fp16, not the fp32 master weights. Consider using more gpus to train faster (if you increase `#gpus`, reduce `gradient_accumulation` to maintain `#tokens/batch` as mentioned earlier). The attention softmax runs in fp32 for numerical stability.
 # 
 # - As a demonstration, this notebook is training on wikitext103 but wikitext103 is rather small that it takes 7 epochs to train for 3k steps Consider doing a single epoch on a larger dataset (800M tokens) instead.
 # 
@@ -199,9 +474,21 @@ def pretrain_and_evaluate(args, model, tokenizer, eval_only, model_path):
 class ModelArgs:
     attention_window: int = field(default=512, metadata={"help": "Size of attention window"})
     max_pos: int = field(default=4096, metadata={"help": "Maximum position"})
+    grad_ckpt: bool = field(default=True, metadata={"help": "Enable gradient checkpointing to save memory"})
+    attention_mode: str = field(default='sliding_chunks', metadata={
+        "help": "Longformer attention implementation. "
+                "'sliding_chunks': PyTorch, fastest, supports fp16, uses ~2x the memory of the sliding window; "
+                "'sliding_chunks_no_overlap': PyTorch, slower, close to the memory of the sliding window; "
+                "'tvm': custom CUDA kernel, least memory but slow and no fp16 support",
+        "choices": ['sliding_chunks', 'sliding_chunks_no_overlap', 'tvm']})
+    force_copy_proj_layers: bool = field(default=False, metadata={"help": "Overwrite global projections even if they are not shared with the local ones"})
+    reload_after_save: bool = field(default=False, metadata={"help": "Reload the final model from the disk to verify it"})
 
 parser = HfArgumentParser((TrainingArguments, ModelArgs,))
 
+# the pinned `transformers` Trainer needs apex for fp16
+apex_available = importlib.util.find_spec('apex') is not None
+
 
 training_args, model_args = parser.parse_args_into_dataclasses(look_for_args_file=False, args=[
     '--output_dir', 'tmp',
@@ -214,19 +501,29 @@ training_args, model_args = parser.parse_args_into_dataclasses(look_for_args_fil
     '--save_steps', '500',
     '--max_grad_norm', '5.0',
     '--per_gpu_eval_batch_size', '8',
-    '--per_gpu_train_batch_size', '2',  # 32GB gpu with fp32
-    '--gradient_accumulation_steps', '32',
+    '--per_gpu_train_batch_size', '8' if apex_available else '4',  # 32GB gpu with gradient checkpointing
+    '--gradient_accumulation_steps', '8' if apex_available else '16',
     '--evaluate_during_training',
     '--do_train',
     '--do_eval',
-])
+] + (['--fp16', '--fp16_opt_level', 'O2'] if apex_available else []))
 training_args.val_datapath = 'wikitext-103-raw/wiki.valid.raw'
 training_args.train_datapath = 'wikitext-103-raw/wiki.train.raw'
+training_args.stream_train_data = False  # set to True to tokenize the training data on the fly instead of caching it
+training_args.dataloader_num_workers = 4
+training_args.dataloader_pin_memory = True
 
 # Choose GPU
 import os
 os.environ["CUDA_VISIBLE_DEVICES"] = "1" #"0"
 
+# On Ampere or newer GPUs, let cuDNN pick the fastest algorithms for our fixed input sizes and use TF32
+# matmuls. Older GPUs keep the defaults.
+if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
 
 # ### Put it all together
 # 
@@ -242,37 +539,44 @@ pretrain_and_evaluate(training_args, roberta_base, roberta_base_tokenizer, eval_
 
 
 # 2) As descriped in `create_long_model`, convert a `roberta-base` model into `roberta-base-4096` which is an instance of `RobertaLong`, then save it to the disk.
+# 
+# 3) If `roberta-base-4096` is already on the disk (e.g. when resuming), load it instead. The model directory is keyed on the conversion parameters, so changing them doesn't reuse a stale model. It only ever holds the converted model; the pretrained model is saved to `{model_path}-pretrained`. This model works for long sequences even without pretraining. If you don't want to pretrain, you can stop here and start finetuning your `roberta-base-4096` on downstream tasks 🎉🎉🎉
 
 # In[ ]:
 
 
-model_path = f'{training_args.output_dir}/roberta-base-{model_args.max_pos}'
-if not os.path.exists(model_path):
-    os.makedirs(model_path)
-
-logger.info(f'Converting roberta-base into roberta-base-{model_args.max_pos}')
-model, tokenizer = create_long_model(
-    save_model_to=model_path, attention_window=model_args.attention_window, max_pos=model_args.max_pos)
-
-
-# 3) Load `roberta-base-4096` from the disk. This model works for long sequences even without pretraining. If you don't want to pretrain, you can stop here and start finetuning your `roberta-base-4096` on downstream tasks 🎉🎉🎉
-
-# In[ ]:
-
-
-logger.info(f'Loading the model from {model_path}')
-tokenizer = RobertaTokenizerFast.from_pretrained(model_path)
-model = RobertaLongForMaskedLM.from_pretrained(model_path)
+cache_key = f'roberta-base-{model_args.attention_window}-{model_args.max_pos}-{transformers.__version__}'
+cache_key = hashlib.md5(cache_key.encode()).hexdigest()[:12]
+model_path = f'{training_args.output_dir}/roberta-base-{model_args.max_pos}-{cache_key}'
+pretrained_model_path = f'{model_path}-pretrained'
+need_build = not os.path.exists(os.path.join(model_path, 'pytorch_model.bin'))
+if need_build:
+    os.makedirs(model_path, exist_ok=True)
+    logger.info(f'Converting roberta-base into roberta-base-{model_args.max_pos}')
+    model, tokenizer = create_long_model(
+        save_model_to=model_path, attention_window=model_args.attention_window, max_pos=model_args.max_pos,
+        attention_mode=model_args.attention_mode)
+else:
+    logger.info(f'Loading the model from {model_path}')
+    tokenizer = RobertaTokenizerFast.from_pretrained(model_path)
+    config = RobertaConfig.from_pretrained(model_path)
+    config.attention_mode = model_args.attention_mode
+    model = RobertaLongForMaskedLM.from_pretrained(model_path, config=config)
+    # loading from the disk breaks the sharing of the global projections. MLM pretraining doesn't train them,
+    # so share them again for `copy_proj_layers` to copy the pretrained local projections into them
+    model = share_proj_layers(model)
 
 
 # 4) Pretrain `roberta-base-4096` for `3k` steps, each steps has `2^18` tokens. Notes: 
 # 
 # - The `training_args.max_steps = 3 ` is just for the demo. **Remove this line for the actual training**
 # 
-# - Training for `3k` steps will take 2 days on a single 32GB gpu with `fp32`. Consider using `fp16` and more gpus to train faster. 
+# - Training for `3k` steps will take 2 days on a single 32GB gpu with `fp32`. `fp16` is faster, and consider using more gpus to train faster. 
 # 
 # - Tokenizing the training data the first time is going to take 5-10 minutes.
 # 
+# - Gradient checkpointing on the encoder layers is only enabled while pretraining, so it isn't turned on in the config of the saved model.
+# 
 # - MLM validation `bpc` **before** pretraining: **2.652**, a bit worse than the **2.536** of `roberta-base`. As discussed in [the paper](https://arxiv.org/pdf/2004.05150.pdf) this is expected because the model didn't learn yet to work with the sliding window attention. 
 # 
 # - MLM validation `bpc` after pretraining for a few number of steps: **2.628**. It is quickly getting better. By 3k steps, it should be better than the **2.536** of `roberta-base`.
@@ -284,7 +588,11 @@ logger.info(f'Pretraining roberta-base-{model_args.max_pos} ... ')
 
 training_args.max_steps = 3   ## <<<<<<<<<<<<<<<<<<<<<<<< REMOVE THIS <<<<<<<<<<<<<<<<<<<<<<<<
 
-pretrain_and_evaluate(training_args, model, tokenizer, eval_only=False, model_path=training_args.output_dir)
+model.config.gradient_checkpointing = model_args.grad_ckpt
+try:
+    pretrain_and_evaluate(training_args, model, tokenizer, eval_only=False, model_path=training_args.output_dir)
+finally:
+    model.config.gradient_checkpointing = False
 
 
 # 5) Copy global projection layers. MLM pretraining doesn't train global projections, so we need to call `copy_proj_layers` to copy the local projection layers to the global ones.
@@ -293,21 +601,23 @@ pretrain_and_evaluate(training_args, model, tokenizer, eval_only=False, model_pa
 
 
 logger.info(f'Copying local projection layers into global projection layers ... ')
-model = copy_proj_layers(model)
-logger.info(f'Saving model to {model_path}')
-model.save_pretrained(model_path)
+model = copy_proj_layers(model, force=model_args.force_copy_proj_layers)
+logger.info(f'Saving model to {pretrained_model_path}')
+model.save_pretrained(pretrained_model_path)
+tokenizer.save_pretrained(pretrained_model_path)
 
 
 # 🎉🎉🎉🎉 **DONE**. 🎉🎉🎉🎉
 # 
-# `model` can now be used for finetuning on downstream tasks after loading it from the disk. 
+# `model` can now be used for finetuning on downstream tasks after loading it from the disk. Set `--reload_after_save` to verify that the saved model loads correctly.
 # 
 # 
 
 # In[ ]:
 
 
-logger.info(f'Loading the model from {model_path}')
-tokenizer = RobertaTokenizerFast.from_pretrained(model_path)
-model = RobertaLongForMaskedLM.from_pretrained(model_path)
+if model_args.reload_after_save:
+    logger.info(f'Loading the model from {pretrained_model_path}')
+    tokenizer = RobertaTokenizerFast.from_pretrained(pretrained_model_path)
+    model = RobertaLongForMaskedLM.from_pretrained(pretrained_model_path)
 